@@ -1,5 +1,13 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import os
+import shelve
+import threading
+import time
+
+import numpy as np
 import pandas as pd
 import pubchempy as pcp
 
@@ -23,128 +31,451 @@ class CompoundProcessor:
     SMILES_NAME = 'smiles'
     LOGP_NAME = 'logP'
 
-        
-    def process_input(self, variants_input : list) -> tuple:
-        """Normalize compound names and add additional properties.
+    # Type of the text columns (compact arrow strings instead of python objects).
+    STRING_DTYPE = 'string[pyarrow]'
+
+    # PubChem properties of the compounds (fetched in bulk for all compounds at once).
+    PUBCHEM_MOLECULAR_WEIGHT = 'MolecularWeight'
+    PUBCHEM_SMILES = 'IsomericSMILES'
+    PUBCHEM_LOGP = 'XLogP'
+
+    # PubChem allows at most 5 requests per second -> the starts of the requests (shared 
+    # by all parallel workers) are spaced at least `1 / MAX_REQUESTS_PER_SECOND` apart.
+    MAX_REQUESTS_PER_SECOND = 5
+    MAX_PARALLEL_REQUESTS = 5
+    # Retries of the requests refused because of the busy server (HTTP 503),
+    # the delay (in seconds) is doubled after each retry.
+    MAX_RETRIES = 4
+    RETRY_DELAY = 0.5
+
+    # Time (in seconds) after which the on-disk cache of PubChem results is discarded.
+    CACHE_EXPIRATION = 24 * 60 * 60
+
+    # Start time of the last PubChem request (shared by all processor instances and threads).
+    _request_lock = threading.Lock()
+    _last_request_time = 0.0
+
+
+    def __init__(self, cache_filename='pubchem_cache'):
+        """Initialize the processor.
 
-        This function normalizes compound names and extracts additional properties 
-        from PubChem database.
-        
         Args:
-            variants_input (list): List of compound names to be processed.
+            cache_filename (str, optional): Name of the file to persist the PubChem 
+            results between the runs. If `None`, then results are cached only in memory.
+            Defaults to "pubchem_cache".
+        """
+        self.cache_filename = cache_filename
+        self._cache_timestamp = time.time()
+
+        # PubChem CIDs of the already queried compound names (`None` if not found), 
+        # normalized forms and properties of the already fetched compounds, so that 
+        # repeated calls of `process_input` do not query PubChem again.
+        self._resolved_cids = {}
+        self._normed_forms = {}
+        self._fetched_compounds = {}
+
+        if self.cache_filename:
+            self._load_cache()
+
+
+    def _load_cache(self):
+        """Load the PubChem results stored by the previous runs (if not expired)."""
+        with shelve.open(self.cache_filename) as cache:
+            timestamp = cache.get('timestamp', 0)
+
+            # Outdated cache -> PubChem data could have changed, query them again.
+            if time.time() - timestamp > CompoundProcessor.CACHE_EXPIRATION:
+                return
+
+            self._cache_timestamp = timestamp
+            self._resolved_cids = cache.get('cids', {})
+            self._normed_forms = cache.get('normed_forms', {})
+            self._fetched_compounds = cache.get('compounds', {})
+
+
+    def _save_cache(self):
+        """Store the PubChem results for the next runs."""
+        with shelve.open(self.cache_filename) as cache:
+            cache['timestamp'] = self._cache_timestamp
+            cache['cids'] = self._resolved_cids
+            cache['normed_forms'] = self._normed_forms
+            cache['compounds'] = self._fetched_compounds
+
+
+    @staticmethod
+    def _wait_for_request_slot():
+        """Block until the next PubChem request can be sent without exceeding the rate limit."""
+        with CompoundProcessor._request_lock:
+            wait_time = (
+                CompoundProcessor._last_request_time 
+                + 1 / CompoundProcessor.MAX_REQUESTS_PER_SECOND 
+                - time.monotonic()
+            )
+            if wait_time > 0:
+                time.sleep(wait_time)
+
+            CompoundProcessor._last_request_time = time.monotonic()
+
+
+    @staticmethod
+    def _query_pubchem(query, *args):
+        """Call the PubChem query function, retry it while the server is busy.
+
+        Args:
+            query (callable): `pubchempy` function to call.
+            *args: Arguments of the query function.
 
         Returns:
-            tuple: A tuple containing two pd.DataFrames:
-                   - DataFrame with mapping of original compound names to normalized forms.
-                   - DataFrame with normalized compounds and their properties.
+            Result of the query function.
         """
+        for attempt in range(CompoundProcessor.MAX_RETRIES):
+            CompoundProcessor._wait_for_request_slot()
 
-        # In order to reduce the number of requests to PubChem databasis we normalize and
-        # add properties at once.
+            try:
+                return query(*args)
+            except pcp.PubChemHTTPError as e:
+                # Only the generic `PubChemHTTPError` carries the HTTP code (its subclasses do not).
+                if getattr(e, 'code', None) != 503 or attempt == CompoundProcessor.MAX_RETRIES - 1:
+                    raise
 
-        processed_data = []
-        org_norm_mapping = {}
+                # Server busy -> wait with exponential backoff.
+                time.sleep(CompoundProcessor.RETRY_DELAY * 2**attempt)
 
-        # For fast checking whether the properties of the normalized compound are already added. 
-        normed_formes_set = set()
 
-        for name in variants_input:
-            pubchem_compounds = pcp.get_compounds(name, 'name')
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _find_cid(name : str) -> int:
+        """Query PubChem for the CID of the compound.
 
-            if pubchem_compounds:
-                # Compound found -> take the first matching variant.
-                compound = pubchem_compounds[0]
+        The results are cached in memory for all processor instances.
 
-                # Normalized form it the first synonym in uppercase.
-                normed_form_name = compound.synonyms[0].upper()
-                org_norm_mapping[name] = normed_form_name
+        Args:
+            name (str): Name of the compound.
 
-                # Compound already processed -> skip properties addition.
-                if normed_form_name in normed_formes_set:
-                    continue
+        Returns:
+            int: CID of the first matching compound, `None` if the compound was not found.
+        """
+        # Only the identifiers are requested, properties are fetched in bulk later.
+        cids = CompoundProcessor._query_pubchem(pcp.get_cids, name, 'name')
+        return cids[0] if cids else None
+
+
+    def _resolve_cid(self, name : str) -> int:
+        """Find PubChem CID of the compound.
 
-                normed_formes_set.add(normed_form_name)
+        The results are cached in the processor instance (and its on-disk cache).
 
-                # Add properties of the compound.
-                processed_data.append({
-                    CompoundProcessor.NORMED_FORM_NAME : normed_form_name,
-                    CompoundProcessor.MOLECULAR_WEIGHT_NAME : compound.molecular_weight,
-                    CompoundProcessor.SMILES_NAME : compound.isomeric_smiles,
-                    CompoundProcessor.LOGP_NAME : compound.xlogp,
-                })
+        Args:
+            name (str): Name of the compound.
+
+        Returns:
+            int: CID of the first matching compound, `None` if the compound was not found.
+        """
+        if name in self._resolved_cids:
+            return self._resolved_cids[name]
+
+        cid = CompoundProcessor._find_cid(name)
+
+        self._resolved_cids[name] = cid
+        return cid
+
+
+    def _fetch_normed_forms(self, cids : list) -> dict:
+        """Fetch normalized forms of the compounds.
+
+        Synonyms of all compounds not fetched yet are requested from PubChem at once.
+
+        Args:
+            cids (list): PubChem CIDs of the compounds.
+
+        Returns:
+            dict: Mapping of the CIDs to the normalized forms of the compounds.
+        """
+        missing_cids = [cid for cid in dict.fromkeys(cids) if cid not in self._normed_forms]
+
+        if missing_cids:
+            # Normalized form is the first synonym in uppercase.
+            for synonyms in self._query_pubchem(pcp.get_synonyms, missing_cids, 'cid'):
+                self._normed_forms[synonyms['CID']] = synonyms['Synonym'][0].upper()
+
+        return {cid : self._normed_forms[cid] for cid in cids}
+
+
+    def _fetch_compounds(self, cids : list) -> dict:
+        """Fetch normalized forms and properties of the compounds.
+
+        All compounds not fetched yet are requested from PubChem at once (one request 
+        for the properties and one for the synonyms, see `_fetch_normed_forms`) instead 
+        of one by one.
+
+        Args:
+            cids (list): PubChem CIDs of the compounds.
+
+        Returns:
+            dict: Mapping of the CIDs to the normalized forms and properties of the compounds.
+        """
+        missing_cids = [cid for cid in dict.fromkeys(cids) if cid not in self._fetched_compounds]
+
+        if missing_cids:
+            pubchem_properties = self._query_pubchem(
+                pcp.get_properties,
+                [
+                    CompoundProcessor.PUBCHEM_MOLECULAR_WEIGHT,
+                    CompoundProcessor.PUBCHEM_SMILES,
+                    CompoundProcessor.PUBCHEM_LOGP,
+                ],
+                missing_cids,
+                'cid',
+            )
+
+            normed_forms = self._fetch_normed_forms(missing_cids)
+
+            for properties in pubchem_properties:
+                cid = properties['CID']
+                self._fetched_compounds[cid] = {
+                    CompoundProcessor.NORMED_FORM_NAME : normed_forms[cid],
+                    CompoundProcessor.MOLECULAR_WEIGHT_NAME : 
+                        float(properties.get(CompoundProcessor.PUBCHEM_MOLECULAR_WEIGHT, 'nan')),
+                    CompoundProcessor.SMILES_NAME : 
+                        properties.get(CompoundProcessor.PUBCHEM_SMILES),
+                    CompoundProcessor.LOGP_NAME : 
+                        float(properties.get(CompoundProcessor.PUBCHEM_LOGP, 'nan')),
+                }
+
+        return {cid : self._fetched_compounds[cid] for cid in cids}
+
+        
+    def _find_cids(self, variants_input : list) -> tuple:
+        """Find the compounds in PubChem.
+
+        In order to reduce the number of requests to PubChem databasis we first only 
+        find the compounds by their names. The normalized forms and properties of all 
+        of them are then fetched at once.
+
+        Args:
+            variants_input (list): List of compound names to be processed.
+
+        Returns:
+            tuple: A tuple containing:
+                   - list of the found original compound names (in the input order),
+                   - list of their PubChem CIDs.
+        """
+
+        # Repeated input names are resolved only once. PubChem name search is case 
+        # insensitive -> names differing only in the case share one query.
+        names = list(dict.fromkeys(variants_input))
+        lookup_names = [name.casefold() for name in names]
+        unique_lookup_names = list(dict.fromkeys(lookup_names))
+
+        # The requests are latency bound -> send them in parallel.
+        with ThreadPoolExecutor(max_workers=CompoundProcessor.MAX_PARALLEL_REQUESTS) as executor:
+            lookup_cids = dict(
+                zip(unique_lookup_names, executor.map(self._resolve_cid, unique_lookup_names))
+            )
+
+        cids = [lookup_cids[lookup_name] for lookup_name in lookup_names]
+
+        # Found compounds in the input order.
+        org_names = []
+        org_cids = []
+
+        for name, cid in zip(names, cids):
+            if cid is not None:
+                org_names.append(name)
+                org_cids.append(cid)
             else:
                 # Compound not found:
                 # In our case we just print the message to stdout. In real life example, 
                 # we should use better way to inform the user about job failure.
                 print("Compound not found!")
 
+        return org_names, org_cids
+
+
+    def normalize_names(self, variants_input : list) -> tuple:
+        """Normalize compound names.
+
+        Lightweight variant of `process_input` for the case when only the name 
+        mapping is needed (the compound properties are not fetched and no DataFrames 
+        are constructed).
+
+        Args:
+            variants_input (list): List of compound names to be normalized.
+
+        Returns:
+            tuple: A tuple containing two np.ndarrays:
+                   - original names of the found compounds,
+                   - corresponding normalized forms.
+        """
+        org_names, org_cids = self._find_cids(variants_input)
+        normed_forms = self._fetch_normed_forms(org_cids)
+
+        if self.cache_filename:
+            self._save_cache()
+
+        normed_names = [normed_forms[cid] for cid in org_cids]
+
+        return np.array(org_names, dtype=object), np.array(normed_names, dtype=object)
+
+
+    def process_input(self, variants_input : list) -> tuple:
+        """Normalize compound names and add additional properties.
+
+        This function normalizes compound names and extracts additional properties 
+        from PubChem database.
+        
+        Args:
+            variants_input (list): List of compound names to be processed.
+
+        Returns:
+            tuple: A tuple containing two pd.DataFrames:
+                   - DataFrame with mapping of original compound names to normalized forms.
+                   - DataFrame with normalized compounds and their properties.
+        """
+        org_names, org_cids = self._find_cids(variants_input)
+        compounds = self._fetch_compounds(org_cids)
+
+        if self.cache_filename:
+            self._save_cache()
 
         org_norm_mapping = pd.DataFrame(
-            list(org_norm_mapping.items()), 
-            columns=[
-                CompoundProcessor.ORG_FORM_NAME,  
-                CompoundProcessor.NORMED_FORM_NAME
-                ]
+            {
+                CompoundProcessor.ORG_FORM_NAME : pd.array(
+                    org_names, dtype=CompoundProcessor.STRING_DTYPE
+                ),
+                CompoundProcessor.NORMED_FORM_NAME : pd.array(
+                    [compounds[cid][CompoundProcessor.NORMED_FORM_NAME] for cid in org_cids],
+                    dtype=CompoundProcessor.STRING_DTYPE,
+                ),
+            }
+        )
+
+        # The columns are created directly with the final types (no additional recast).
+        fetched_compounds = list(compounds.values())
+
+        def string_column(column):
+            return pd.array(
+                [compound[column] for compound in fetched_compounds],
+                dtype=CompoundProcessor.STRING_DTYPE,
             )
-        
-        compound_properties = pd.DataFrame(processed_data).astype(
+
+        def float_column(column):
+            return np.fromiter(
+                (compound[column] for compound in fetched_compounds), 
+                dtype=float, 
+                count=len(fetched_compounds),
+            )
+
+        compound_properties = pd.DataFrame(
             {
-                CompoundProcessor.NORMED_FORM_NAME : 'str',
-                CompoundProcessor.MOLECULAR_WEIGHT_NAME: 'float',
-                CompoundProcessor.SMILES_NAME : 'str',
-                CompoundProcessor.LOGP_NAME : 'float',
+                CompoundProcessor.NORMED_FORM_NAME : 
+                    string_column(CompoundProcessor.NORMED_FORM_NAME),
+                CompoundProcessor.MOLECULAR_WEIGHT_NAME : 
+                    float_column(CompoundProcessor.MOLECULAR_WEIGHT_NAME),
+                CompoundProcessor.SMILES_NAME : 
+                    string_column(CompoundProcessor.SMILES_NAME),
+                CompoundProcessor.LOGP_NAME : 
+                    float_column(CompoundProcessor.LOGP_NAME),
             }
         )
 
+        # Different compounds can share the normalized form -> keep properties of the first one.
+        compound_properties.drop_duplicates(
+            subset=[CompoundProcessor.NORMED_FORM_NAME], inplace=True, ignore_index=True
+        )
+
         return org_norm_mapping, compound_properties
     
     
-def save_processed_input(processed_data, filename='compound_data.xlsx'):
-    """Save processed data into the excel file."""
-    processed_data.to_excel(filename, index=False)
+def save_table(data : pd.DataFrame, filename : str, parquet=False):
+    """Save the table into the excel file (or parquet file).
+
+    Args:
+        data (pd.DataFrame): Table to save.
+        filename (str): Name of the excel file.
+        parquet (bool, optional): If `True`, then the table is stored in the parquet 
+        format (much faster and smaller than excel) with the `.parquet` extension 
+        instead of the excel file. Defaults to False.
+    """
+    if parquet:
+        parquet_filename = os.path.splitext(filename)[0] + '.parquet'
+        data.to_parquet(parquet_filename, index=False, compression='zstd')
+    else:
+        data.to_excel(filename, index=False, engine='xlsxwriter')
+
 
+def save_processed_input(processed_data, filename='compound_data.xlsx', parquet=False):
+    """Save processed data into the excel file (or parquet file, see `save_table`)."""
+    save_table(processed_data, filename, parquet=parquet)
 
-def compound_score(compound_data : pd.DataFrame) -> float:
-    """Compute score of the compound.
 
-    This function computes the score of the compound necessary for the ranking.
-    The score is equal to molecular weight of the compound.
+# Weights of the compound properties in the score. In our example we rank the data based 
+# on the molecular weight only. In real life example we would probably combine more 
+# properties (and probably deal with different types of the features).
+SCORE_WEIGHTS = {
+    CompoundProcessor.MOLECULAR_WEIGHT_NAME : 1.0,
+}
+
+
+def compound_score(compound_data : pd.DataFrame, weights=SCORE_WEIGHTS) -> pd.Series:
+    """Compute scores of the compounds.
+
+    This function computes the scores of the compounds necessary for the ranking.
+    The score is the weighted sum of the compound properties (by default equal to 
+    molecular weight of the compound).
 
     Args:
-        compound_data (pd.DataFrame): Properties of the compound.
+        compound_data (pd.DataFrame): Properties of the compounds.
+        weights (dict, optional): Mapping of the property columns to their weights. 
+        Defaults to `SCORE_WEIGHTS`.
 
     Returns:
-        float: Score of the compound.
+        pd.Series: Scores of the compounds.
     """
 
-    # In our example we rank the data based on the molecular weight. In real life
-    # example we would probably use more complex scoring function combining the 
-    # properties (and probably dealing with different types of the features).
+    # The scores of all compounds are computed at once as a single matrix-vector product 
+    # (no row-wise `apply`).
+    features = compound_data[list(weights)].to_numpy(dtype=float)
+    feature_weights = np.fromiter(weights.values(), dtype=float, count=len(weights))
 
-    return compound_data[CompoundProcessor.MOLECULAR_WEIGHT_NAME]
+    return pd.Series(features @ feature_weights, index=compound_data.index)
 
 
-def rank_data(compound_data : pd.DataFrame, enriched_filename="enriched_compound_data.xlsx"):
+def rank_data(
+        compound_data : pd.DataFrame, 
+        enriched_filename="enriched_compound_data.xlsx", 
+        parquet=False,
+    ) -> pd.DataFrame:
     """Rank data.
 
     This function ranks data based on the computed score computed by the 
     function `compound_score`.
 
     Args:
-        compound_data (pd.DataFrame): Properties of the compounds to rank. 
-        Will be modified using the function.
+        compound_data (pd.DataFrame): Properties of the compounds to rank 
+        (not modified by the function).
         enriched_filename (str, optional): Name of the file to store the additional 
         information necessary to rank the data. If `None`, then data will not be stored. 
         Defaults to "enriched_compound_data.xlsx".
+        parquet (bool, optional): If `True`, then the additional information is stored 
+        in the parquet format (see `save_table`). Defaults to False.
+
+    Returns:
+        pd.DataFrame: Compounds with the added `score` column sorted by their score.
     """
 
-    compound_data['score'] = compound_data.apply(compound_score, axis=1)
-    compound_data.sort_values(by=['score'], inplace=True, ignore_index=True,)
+    compound_data = compound_data.assign(score=compound_score(compound_data))
+
+    # Sorting by the single numeric key -> sort the raw scores and reorder the rows at once.
+    order = np.argsort(compound_data['score'].to_numpy())
+    compound_data = compound_data.take(order).reset_index(drop=True)
 
     # If we want to maintain the `score` property -> store it to the specified file. 
     if enriched_filename:
-        additional_info = compound_data[[CompoundProcessor.NORMED_FORM_NAME, 'score']]
-        additional_info.to_excel(enriched_filename, index=False)
+        additional_info = compound_data.loc[:, [CompoundProcessor.NORMED_FORM_NAME, 'score']]
+        save_table(additional_info, enriched_filename, parquet=parquet)
+
+    return compound_data
 
 
 # Example usage
@@ -171,8 +502,8 @@ if __name__ == "__main__":
     # Save additional properties into the excel file.
     save_processed_input(processed_data)
     # Rank the data.
-    rank_data(processed_data)#, enriched_filename=None)
+    ranked_data = rank_data(processed_data)#, enriched_filename=None)
 
     print("Bonus Part - Enriching Data and Ranking")
     print("-----------------------------")
-    print(processed_data)
\ No newline at end of file
+    print(ranked_data)
\ No newline at end of file